@@ -1,20 +1,36 @@
-import io
 import traceback
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from io import BytesIO
 from json import dumps, loads
+from datetime import datetime, timezone
 from os import getenv
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterator, BinaryIO
 from functools import cache
+from zlib import crc32
 
 import boto3
+from cachetools import TTLCache, cached
+import numpy as np
+import simplejpeg
 from botocore.exceptions import ClientError
 from botocore.client import Config
-from chalice import Chalice, NotFoundError, BadRequestError
+from boto3.s3.transfer import TransferConfig
+from chalice import Chalice, NotFoundError, BadRequestError, ChaliceViewError
 from chalice.app import ConvertToMiddleware
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools import Tracer
 
 from PIL import Image, UnidentifiedImageError
+try:
+    import pyvips
+except (ImportError, OSError):  # libvips is optional and needs its own Lambda layer
+    pyvips = None
+from pypdf import PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject
 
 
 #########################################################
@@ -22,6 +38,8 @@ from PIL import Image, UnidentifiedImageError
 
 DEFAULT_IMAGE_SCALE = 0.4  # of original size
 DEFAULT_IMAGE_EXTENSIONS = ('jpg', 'tif', 'tiff', 'png')  # use lower case
+DEFAULT_JPEG_QUALITY = 75  # matches Pillow's default JPEG quality
+JPEG_GRAY_MODES = ('1', 'L', 'I;16', 'I;16L', 'I;16B')  # image modes encoded as single channel grayscale JPEGs
 
 SOURCE_BAG_LOCATIONS = ['source', 'private/external-preservation', 'private/preservation', 'private/private', 'private/shareok']
 
@@ -29,9 +47,33 @@ _6GB = 6442450944  # 6 gigabytes in bytes
 _4GB = 4294967296  # 4 gigabytes in bytes
 _2GB = 2147483648  # 2 gigabytes in bytes
 _1GB = 1073741824  # 1 gigabyte in bytes
+_512MB = 536870912  # 512 megabytes in bytes
+_128MB = 134217728  # 128 megabytes in bytes
+_64MB = 67108864  # 64 megabytes in bytes
+_8MB = 8388608  # 8 megabytes in bytes
+_1MB = 1048576  # 1 megabyte in bytes
 
 LAMBDA_MAX_MEMORY_FOR_PDF = getenv('LAMBDA_MAX_MEMORY_FOR_PDF', _4GB)
 LAMBDA_MAX_MEMORY_FOR_DERIV = getenv('LAMBDA_MAX_MEMORY_FOR_DERIV', _2GB)
+LAMBDA_EPHEMERAL_STORAGE = int(getenv('LAMBDA_EPHEMERAL_STORAGE', _512MB))  # size of /tmp - Lambda's default unless raised
+
+PDF_PREFETCH_WORKERS = 16  # number of PDF pages fetched from S3 ahead of the encoder
+SQS_BATCH_SIZE = 10  # maximum number of entries in an SQS SendMessageBatch request
+SQS_SEND_WORKERS = 8  # number of SQS batch requests sent in parallel
+
+S3_STREAM_SPOOL_SIZE = _128MB  # S3 objects larger than this are spooled to /tmp instead of memory
+PDF_SPOOL_SIZE = _64MB  # generated PDFs larger than this are spooled to /tmp instead of memory
+PDF_TRANSFER_CONFIG = TransferConfig(multipart_threshold=_8MB, multipart_chunksize=_8MB, max_concurrency=8, use_threads=True)
+S3_DOWNLOAD_CHUNK_SIZE = _8MB  # byte range fetched per GET when downloading the rest of a source image
+S3_DOWNLOAD_WORKERS = 8  # ranged GETs of a source image sent in parallel
+SOURCE_PREFETCH_BYTES = 262144  # first ranged GET of a source image, also returns the object's total size
+
+CACHE_MAXSIZE = 4096  # entries per cached S3 lookup
+CACHE_TTL = 300  # seconds S3 lookups are reused within a warm Lambda container
+EXISTS_CACHE_MAXSIZE = 65536  # S3 keys with a remembered existence check
+EXISTS_CACHE_TTL = 60  # seconds an existence check is reused, e.g. across SQS retries
+PDF_MANIFEST_PREFIX = 'manifest/pdf'  # refused PDF bags - kept outside derivative/ so they are not listed as derivatives
+PDF_MANIFEST_TTL = 3600  # seconds a refusal is trusted before the bag is listed again
 
 Image.MAX_IMAGE_PIXELS = None  # allow large images
 
@@ -41,8 +83,17 @@ Image.MAX_IMAGE_PIXELS = None  # allow large images
 
 SQS_QUEUE_DERIV = getenv("SQS_QUEUE_DERIV")
 SQS_QUEUE_PDF = getenv("SQS_QUEUE_PDF")
+SQS_QUEUE_DERIV_URL = getenv("SQS_QUEUE_DERIV_URL")  # optional - skips the queue URL lookup on cold start
+SQS_QUEUE_PDF_URL = getenv("SQS_QUEUE_PDF_URL")  # optional - skips the queue URL lookup on cold start
+SQS_QUEUE_DERIV_SHARDS = int(getenv("SQS_QUEUE_DERIV_SHARDS", 1))  # derivative queues, named SQS_QUEUE_DERIV, SQS_QUEUE_DERIV-1, ...
 S3_BUCKET = getenv("S3_BUCKET")
 
+if SQS_QUEUE_DERIV_SHARDS < 1:
+    raise ValueError(f'SQS_QUEUE_DERIV_SHARDS must be at least 1, got {SQS_QUEUE_DERIV_SHARDS}')
+
+PYVIPS_REQUESTED = getenv("USE_PYVIPS", "").lower() in ("1", "true", "yes")
+USE_PYVIPS = pyvips is not None and PYVIPS_REQUESTED
+
 
 ########################################################
 # Chalice application settings
@@ -55,13 +106,17 @@ tracer = Tracer()
 app.register_middleware(ConvertToMiddleware(logger.inject_lambda_context))
 app.register_middleware(ConvertToMiddleware(tracer.capture_lambda_handler))
 
+if PYVIPS_REQUESTED and not USE_PYVIPS:
+    logger.warning('USE_PYVIPS is set but pyvips could not be imported - resizing with Pillow')
+
 
 ########################################################
 # AWS bindings - these are setup as functions to allow mocking in unit tests
 
 @cache
 def get_s3_client():
-    return boto3.client('s3', config=Config(connect_timeout=5, read_timeout=10, retries={'max_attempts': 0}))
+    return boto3.client('s3', config=Config(connect_timeout=5, read_timeout=10, retries={'max_attempts': 0},
+                                            max_pool_connections=PDF_PREFETCH_WORKERS))
 
 
 @cache
@@ -72,31 +127,47 @@ def get_s3_paginator():
 
 @cache
 def get_sqs():
-    return boto3.resource('sqs')
+    return boto3.client('sqs', config=Config(retries={'mode': 'adaptive'}))
 
 
 @cache
-def get_deriv_queue():
+def get_deriv_queue_url(shard: int = 0) -> str:
+    if SQS_QUEUE_DERIV_URL:
+        return _deriv_queue_name(shard, SQS_QUEUE_DERIV_URL)  # queue URLs end with the queue name
     sqs = get_sqs()
-    return sqs.get_queue_by_name(QueueName=SQS_QUEUE_DERIV)
+    return sqs.get_queue_url(QueueName=_deriv_queue_name(shard))['QueueUrl']
 
 
 @cache
-def get_pdf_queue():
+def get_pdf_queue_url() -> str:
+    if SQS_QUEUE_PDF_URL:
+        return SQS_QUEUE_PDF_URL
     sqs = get_sqs()
-    return sqs.get_queue_by_name(QueueName=SQS_QUEUE_PDF)
+    return sqs.get_queue_url(QueueName=SQS_QUEUE_PDF)['QueueUrl']
 
 
 ########################################################
 # Helper functions
 
+def _deriv_queue_name(shard: int, base: str = SQS_QUEUE_DERIV) -> str:
+    """ name of a derivative queue shard - the first shard keeps the unsuffixed queue name """
+    return f'{base}-{shard}' if shard else base
+
+
+def _deriv_shard(bag: str, shards: int = None) -> int:
+    """ pick a derivative queue shard for a bag, stable across processes unlike hash() """
+    return crc32(bag.encode()) % (shards or SQS_QUEUE_DERIV_SHARDS)
+
+
 def _filter_keep(file: str, extensions: tuple[str, ...] = DEFAULT_IMAGE_EXTENSIONS, ignore_orig: bool = True) -> bool:
     """ filters to apply to a file's name to determine if to keep """
-    if not file.lower().endswith(extensions):
+    name = file[file.rfind('/') + 1:]  # avoids building a Path for every key in a listing
+    if name[:1] == '.':  # hidden files - checked before lowercasing the name
         return False
-    if ignore_orig and 'orig' in Path(file).name.lower():
+    low = name.lower()
+    if not low.endswith(extensions):
         return False
-    if Path(file).name.startswith('.'):
+    if ignore_orig and 'orig' in low:
         return False
     return True
 
@@ -121,37 +192,116 @@ def _images(prefix: str, extensions: tuple[str, ...] = DEFAULT_IMAGE_EXTENSIONS,
                 yield {'file': file, 'size': size}
 
 
-@cache
-def _find_source_bag(bag: str) -> str:
-    """ find a bag in S3 returning path and bag name"""
+@cached(TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL))
+def _find_source_location(bag: str) -> str:
+    """ find a bag in S3 returning its location and bag name as a path """
     for location in SOURCE_BAG_LOCATIONS:
         key = f'{location}/{bag}/bagit.txt'
         try:
             s3_client = get_s3_client()
             s3_client.head_object(Bucket=S3_BUCKET, Key=key)
-            return {"location": f'{location}/{bag}'}
+            return f'{location}/{bag}'
         except ClientError as e:
             continue  # try next location
     raise NotFoundError('Could not find bag matching request!')
 
 
-def _s3_byte_stream(bucket: str, key: str) -> BinaryIO:
-    """ return an S3 object's data as a BytesIO stream """
+def _find_source_bag(bag: str) -> dict:
+    """ find a bag in S3 returning path and bag name"""
+    return {"location": _find_source_location(bag)}  # a new dict per caller - only the path is cached
+
+
+def _s3_get(bucket: str, key: str, first_byte: int = 0, range_bytes: int = None, etag: str = None) -> dict:
+    """
+    GET an S3 object and return the response with its body still unread
+    first_byte and range_bytes limit the download to a byte range of the object
+    etag fails the request if the object has changed since an earlier GET
+    """
     s3_client = get_s3_client()
+    params = {}
+    if first_byte or range_bytes:
+        last_byte = first_byte + range_bytes - 1 if range_bytes else ''
+        params['Range'] = f'bytes={first_byte}-{last_byte}'
+    if etag:
+        params['IfMatch'] = etag
     try:
-        return io.BytesIO(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
-    except ClientError:
+        return s3_client.get_object(Bucket=bucket, Key=key, **params)
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if first_byte == 0 and code == 'InvalidRange':
+            return {'Body': BytesIO(), 'ContentLength': 0}  # a ranged GET from the first byte of an empty object is not satisfiable
+        if code == 'PreconditionFailed':
+            raise BadRequestError('Object changed during download!')
         raise NotFoundError('Could not access object!')
 
 
-@cache
-def _object_size(bucket: str, key: str) -> int:
-    """ return the file size of an S3 object in bytes """
+def _s3_total_size(response: dict) -> int:
+    """ return the total size in bytes of the object behind a GET response, which may cover only a byte range """
+    if 'ContentRange' in response:  # e.g. "bytes 0-262143/1048576"
+        return int(response['ContentRange'].split('/')[-1])
+    return response['ContentLength']
+
+
+def _spool_size(size: int, spool_size: int = S3_STREAM_SPOOL_SIZE) -> int:
+    """ max_size for a SpooledTemporaryFile holding size bytes - 0 keeps the data in memory when it may not fit in /tmp """
+    return 0 if _is_file_too_large(size, max_size=LAMBDA_EPHEMERAL_STORAGE, buffer_ratio=0.3) else spool_size
+
+
+def _s3_copy(bucket: str, key: str, stream: BinaryIO, first_byte: int = 0, range_bytes: int = None) -> int:
+    """
+    copy an S3 object's data into a stream in chunks and return the object's total size in bytes
+    first_byte and range_bytes limit the download to a byte range of the object
+    """
+    response = _s3_get(bucket, key, first_byte=first_byte, range_bytes=range_bytes)
+    copyfileobj(response['Body'], stream, _1MB)
+    return _s3_total_size(response)
+
+
+def _s3_download(bucket: str, key: str, stream: BinaryIO, first_byte: int, size: int, etag: str = None,
+                 chunk_size: int = S3_DOWNLOAD_CHUNK_SIZE, max_workers: int = S3_DOWNLOAD_WORKERS) -> None:
+    """
+    append bytes first_byte through size of an S3 object to a stream using parallel ranged GETs
+    size and etag come from an earlier GET, so no HEAD request is needed and every range comes from the same version
+    """
+    def fetch(start: int) -> bytes:
+        return _s3_get(bucket, key, first_byte=start, range_bytes=min(chunk_size, size - start), etag=etag)['Body'].read()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for data in executor.map(fetch, range(first_byte, size, chunk_size)):  # in order
+            stream.write(data)
+
+
+def _s3_byte_stream(bucket: str, key: str) -> BinaryIO:
+    """
+    return an S3 object's data as a seekable stream
+    the body is copied in chunks and spooled to disk past S3_STREAM_SPOOL_SIZE to limit memory use, if it fits in /tmp
+    """
+    response = _s3_get(bucket, key)
+    stream = SpooledTemporaryFile(max_size=_spool_size(response['ContentLength']))
+    copyfileobj(response['Body'], stream, _1MB)
+    stream.seek(0)
+    return stream
+
+
+_s3_exists_cache = TTLCache(maxsize=EXISTS_CACHE_MAXSIZE, ttl=EXISTS_CACHE_TTL)
+
+
+def _s3_object_exists(bucket: str, key: str) -> bool:
+    """ check if an S3 object exists, reusing a recent answer instead of another HEAD request """
+    try:
+        return _s3_exists_cache[(bucket, key)]
+    except KeyError:
+        pass  # not checked recently
     s3_client = get_s3_client()
     try:
-        return s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
-    except ClientError:
-        raise NotFoundError('Could not access object!')
+        s3_client.head_object(Bucket=bucket, Key=key)
+        exists = True
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            return False  # denied, throttled or a server error - treat as missing this time but do not remember it
+        exists = False
+    _s3_exists_cache[(bucket, key)] = exists
+    return exists
 
 
 @cache
@@ -166,65 +316,198 @@ def _is_file_too_large(file_sizes: int or tuple[int, ...], max_size: int = LAMBD
     return max_size * (1 - buffer_ratio) - total_size < 0
 
 
+def _encode_jpeg(image: Image.Image, quality: int = DEFAULT_JPEG_QUALITY) -> bytes:
+    """ encode an image as JPEG bytes using simplejpeg (libjpeg-turbo) instead of Pillow's encoder """
+    if image.mode == '1':
+        image = image.convert('L')
+    if image.mode.startswith('I;16'):  # 16 bit grayscale - keep the high byte rather than clipping at 255
+        gray = (np.asarray(image) >> 8).astype(np.uint8)
+        return simplejpeg.encode_jpeg(gray[..., np.newaxis], quality=quality, colorspace='GRAY')
+    if image.mode == 'L':
+        return simplejpeg.encode_jpeg(np.asarray(image)[..., np.newaxis], quality=quality, colorspace='GRAY')
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return simplejpeg.encode_jpeg(np.asarray(image), quality=quality, colorspace='RGB', colorsubsampling='420')
+
+
+def _vips_resize(stream: BinaryIO, scale: float, quality: int = DEFAULT_JPEG_QUALITY) -> bytes:
+    """
+    resize an image by scale with libvips and return JPEG bytes
+    libvips reads the stream through a seekable source, so a spooled file is never copied into memory
+    thumbnail uses shrink-on-load and processes the image in strips, so a full size copy is never held in memory
+    """
+    source = pyvips.SourceCustom()
+    source.on_read(stream.read)
+    source.on_seek(stream.seek)  # lets libvips rewind the source after reading the header
+    header = pyvips.Image.new_from_source(source, '', access='sequential')  # header only
+    image = pyvips.Image.thumbnail_source(source, round(header.width * scale), height=round(header.height * scale),
+                                          size='down')  # never enlarge, like Pillow's thumbnail
+    if image.hasalpha():
+        image = image.flatten(background=255)
+    if image.interpretation not in ('srgb', 'b-w'):
+        image = image.colourspace('srgb')
+    return image.jpegsave_buffer(Q=quality)
+
+
+def _prefetch_images(image_paths: tuple[str, ...], max_workers: int = PDF_PREFETCH_WORKERS) -> Iterator[Image.Image]:
+    """ yield opened S3 images in order while downloading up to max_workers images ahead in a thread pool """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        try:
+            for image_path in image_paths:
+                pending.append(executor.submit(_s3_byte_stream, S3_BUCKET, image_path))
+                if len(pending) >= max_workers:
+                    yield Image.open(pending.popleft().result())
+            while pending:
+                yield Image.open(pending.popleft().result())
+        finally:  # consumer stopped early - drop downloads that have not started yet
+            for future in pending:
+                future.cancel()
+
+
+def _send_message_batches(queue_url: str, message_bodies: list[str]) -> None:
+    """ send messages to an SQS queue in batches of SQS_BATCH_SIZE, with batch requests sent in parallel """
+    sqs = get_sqs()
+
+    def send_batch(batch: list[dict]) -> int:
+        """ send a batch, retry its failed entries once and return how many still failed """
+        resp = sqs.send_message_batch(QueueUrl=queue_url, Entries=batch)  # clients are thread safe
+        logger.debug(resp)
+        failed_ids = {failed['Id'] for failed in resp.get('Failed', [])}
+        if not failed_ids:
+            return 0
+        resp = sqs.send_message_batch(QueueUrl=queue_url, Entries=[entry for entry in batch if entry['Id'] in failed_ids])
+        logger.debug(resp)
+        for failed in resp.get('Failed', []):
+            logger.error(f"Failed to queue message: {failed}")
+        return len(resp.get('Failed', []))
+
+    batches = [
+        [{'Id': str(index), 'MessageBody': body} for index, body in enumerate(message_bodies[start:start + SQS_BATCH_SIZE])]
+        for start in range(0, len(message_bodies), SQS_BATCH_SIZE)
+    ]
+    with ThreadPoolExecutor(max_workers=SQS_SEND_WORKERS) as executor:
+        failed_count = sum(executor.map(send_batch, batches))
+    if failed_count:
+        raise ChaliceViewError(f'Failed to queue {failed_count} of {len(message_bodies)} messages')
+
+
+def _add_pdf_page(pdf: PdfWriter, image: Image.Image) -> None:
+    """
+    add an image to a PDF as a page sized to the image at 72 dpi
+    JPEG data is embedded as-is (DCTDecode) rather than decoded and re-encoded, other formats are encoded to JPEG
+    """
+    if image.format == 'JPEG' and image.mode in ('L', 'RGB'):
+        image.fp.seek(0)
+        data = image.fp.read()
+    else:
+        data = _encode_jpeg(image)
+    width, height = image.size
+    xobject = DecodedStreamObject()
+    xobject.set_data(data)
+    xobject.update({
+        NameObject('/Type'): NameObject('/XObject'),
+        NameObject('/Subtype'): NameObject('/Image'),
+        NameObject('/Width'): NumberObject(width),
+        NameObject('/Height'): NumberObject(height),
+        NameObject('/ColorSpace'): NameObject('/DeviceGray' if image.mode in JPEG_GRAY_MODES else '/DeviceRGB'),
+        NameObject('/BitsPerComponent'): NumberObject(8),
+        NameObject('/Filter'): NameObject('/DCTDecode'),
+    })
+    contents = DecodedStreamObject()
+    contents.set_data(f'q {width} 0 0 {height} 0 0 cm /Im0 Do Q'.encode())
+
+    page = pdf.add_blank_page(width=width, height=height)
+    # streams must be indirect objects - pypdf (4.3.1 as pinned, still true in 6.x) has no public call for that,
+    # so this uses the same private PdfWriter._add_object that replace_contents uses; test__add_pdf_page guards it
+    page[NameObject('/Resources')] = DictionaryObject({
+        NameObject('/XObject'): DictionaryObject({NameObject('/Im0'): pdf._add_object(xobject)})
+    })
+    page.replace_contents(contents)
+
+
 def _generate_pdf(bag: str, title: str = None, author: str = None, subject: str = None, keywords: str = None) -> dict:
     """ Generates PDF from default derivative images """
     destination = f'derivative/{bag}/pdf/{bag}.pdf'
     s3_client = get_s3_client()
 
-    try:  # Test for existing pdf
-        s3_client.head_object(Bucket=S3_BUCKET, Key=destination)
-        logger.info(f'PDF already exists: {destination}')
+    if _s3_object_exists(S3_BUCKET, destination):  # Test for existing pdf
+        logger.info('PDF already exists: %s', destination)
         return {'message': 'PDF already exists'}
+
+    # Test a recent refusal before paying for a new listing - bags known to be too large are refused right away
+    manifest_key = f'{PDF_MANIFEST_PREFIX}/{bag}.json'
+    manifest_found = False
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=manifest_key)
+        manifest_found = True
+        manifest_age = (datetime.now(timezone.utc) - response['LastModified']).total_seconds()
+        manifest_size = loads(response['Body'].read())['total_size']
+        if manifest_age < PDF_MANIFEST_TTL and _is_file_too_large(manifest_size, max_size=LAMBDA_MAX_MEMORY_FOR_PDF, buffer_ratio=0.3):
+            logger.error(f'Total size of derivatives in manifest is more than half of available memory: {manifest_size}')
+            return {'message': 'Memory limit exceeded!'}
     except ClientError:
-        pass  # does not exist - continue
+        pass  # no previous refusal
+    except (ValueError, KeyError, TypeError):
+        logger.warning(f'Ignoring unreadable PDF manifest for bag: {bag}')  # list the bag again instead
 
     try:  # Test for existing derivatives
-        image_paths, image_sizes = zip(
-            *((item['file'], item['size'])  # returning tuples
-              for item in images_derivative(bag, scale=DEFAULT_IMAGE_SCALE)
-              )
-        )
+        derivatives = images_derivative(bag, scale=DEFAULT_IMAGE_SCALE)
     except NotFoundError:
+        derivatives = []
+    if not derivatives:
         logger.error('Missing derivative - failed to generate PDF')
         return {'message': 'missing derivative to generate PDF'}
+    image_paths = []
+    total_size = 0
+    for item in derivatives:  # single pass for paths and total size
+        image_paths.append(item['file'])
+        total_size += item['size']
 
     # Test total size of derivatives is under half of allocated memory size
-    logger.debug(f'Total size of derivatives: {sum(image_sizes)}')
-    logger.debug(f'LAMBDA_MAX_MEMORY_FOR_PDF: {LAMBDA_MAX_MEMORY_FOR_PDF}')
-    if _is_file_too_large(image_sizes, max_size=LAMBDA_MAX_MEMORY_FOR_PDF, buffer_ratio=0.3):
-        logger.error(f'Total size of derivatives is more than half of available memory: {sum(image_sizes)}')
+    logger.debug('Total size of derivatives: %s', total_size)
+    logger.debug('LAMBDA_MAX_MEMORY_FOR_PDF: %s', LAMBDA_MAX_MEMORY_FOR_PDF)
+    if _is_file_too_large(total_size, max_size=LAMBDA_MAX_MEMORY_FOR_PDF, buffer_ratio=0.3):
+        logger.error(f'Total size of derivatives is more than half of available memory: {total_size}')
+        try:  # remember the refusal so retries skip the listing
+            s3_client.put_object(Bucket=S3_BUCKET, Key=manifest_key, Body=dumps(
+                {'total_size': total_size, 'page_count': len(image_paths), 'paths': image_paths}
+            ))
+        except ClientError:
+            logger.error(f'Failed to save PDF manifest for bag: {bag}')
         return {'message': 'Memory limit exceeded!'}
+    if manifest_found:  # the bag fits now - drop the old refusal
+        try:
+            s3_client.delete_object(Bucket=S3_BUCKET, Key=manifest_key)
+        except ClientError:
+            logger.error(f'Failed to delete PDF manifest for bag: {bag}')
 
-    # get contents of first image to bootstrap PDF generation
-    image_path = image_paths[0]
+    pdf = PdfWriter()
+    pages = _prefetch_images(image_paths)
     try:
-        pdf = Image.open(_s3_byte_stream(bucket=S3_BUCKET, key=image_path))
-
-        # save generated PDF back to S3
-        pdf_file = io.BytesIO()
-        pdf.save(
-            pdf_file,
-            format='PDF',
-            save_all=True,
-            title=title,
-            author=author,
-            subject=subject,
-            keywords=keywords,
-            append_images=(
-                Image.open(_s3_byte_stream(bucket=S3_BUCKET, key=image_path))
-                for image_path in image_paths[1:]  # skipping first image used to bootstrap pdf
-            )
-        )
+        for page in pages:
+            _add_pdf_page(pdf, page)
+            page.close()  # page data now lives in the PDF
     except UnidentifiedImageError:
         raise BadRequestError("An image is invalid for PDF generation.")
-    pdf_file.flush()
+    finally:
+        pages.close()  # release the thread pool and any prefetched pages right away
+    pdf.add_metadata({
+        key: value for key, value in (('/Title', title), ('/Author', author), ('/Subject', subject), ('/Keywords', keywords))
+        if value
+    })
+
+    # save generated PDF back to S3
+    pdf_file = SpooledTemporaryFile(max_size=_spool_size(total_size, PDF_SPOOL_SIZE))  # about the size of its derivatives
+    pdf.write(pdf_file)
     pdf_file.seek(0)
-    try:
-        s3_client.put_object(Bucket=S3_BUCKET, Key=destination, Body=pdf_file)
+    try:  # multipart upload for PDFs past the threshold
+        s3_client.upload_fileobj(pdf_file, S3_BUCKET, destination, Config=PDF_TRANSFER_CONFIG)
     except:
         logger.error(f'Failed to save PDF to S3 for bag: {bag}')
         return {'message': 'failed to save PDF file'}
-    logger.info(f'Generated PDF for bag: {bag}')
+    _s3_exists_cache[(S3_BUCKET, destination)] = True
+    logger.info('Generated PDF for bag: %s', bag)
     return {'message': 'success'}
 
 
@@ -241,7 +524,7 @@ def pdf_generator(event) -> None:
             _generate_pdf(**record_body)
         except (NotFoundError, BadRequestError) as e:
             logger.error(f"Failed to generate PDF: {record_body['bag']}")
-        logger.debug(f"Created PDF: {record_body['bag']}")
+        logger.debug('Created PDF: %s', record_body['bag'])
 
 
 @app.on_sqs_message(queue=SQS_QUEUE_DERIV, batch_size=1)
@@ -255,7 +538,11 @@ def deriv_generator(event) -> None:
             resize_individual(bag, scale, image, location)
         except (NotFoundError, BadRequestError) as e:
             logger.error(f"Failed to resize: {bag}, {image}")
-        logger.debug(f"Resized: {bag}, {image} -> {scale}, {location}")
+        logger.debug('Resized: %s, %s -> %s, %s', bag, image, scale, location)
+
+
+for _shard in range(1, SQS_QUEUE_DERIV_SHARDS):  # an event source and Lambda function per additional shard queue
+    app.on_sqs_message(queue=_deriv_queue_name(_shard), batch_size=1, name=f'deriv_generator_{_shard}')(deriv_generator.func)
 
 
 ########################################################
@@ -302,10 +589,11 @@ def generate_pdf(bag: str) -> dict:
     """ API endpoint for requesting PDF generation """
     request = app.current_request
     data = request.json_body if request.json_body else {}
-    pdf_queue = get_pdf_queue()
-    logger.debug(f'Using queue: {pdf_queue}')
-    logger.info(f'Processing {bag}')
-    resp = pdf_queue.send_message(
+    pdf_queue_url = get_pdf_queue_url()
+    logger.debug('Using queue: %s', pdf_queue_url)
+    logger.info('Processing %s', bag)
+    resp = get_sqs().send_message(
+        QueueUrl=pdf_queue_url,
         MessageBody=dumps(
             {
                 'bag': bag,
@@ -327,35 +615,47 @@ def resize_individual(bag: str, scale: float, image_path: str, location: str = "
     destination = f'derivative/{bag}/{scale}/{deriv_image_path}'
     s3_client = get_s3_client()
 
-    try:  # Test for existing derivative
-        s3_client.head_object(Bucket=S3_BUCKET, Key=destination)
-        logger.info(f'Derivative already exists: {destination}')
+    if _s3_object_exists(S3_BUCKET, destination):  # Test for existing derivative
+        logger.info('Derivative already exists: %s', destination)
         return {'message': 'image already exists'}
-    except ClientError:
-        pass  # does not exist - continue
 
     bag_location = location if location else _find_source_bag(bag)['location']
-    if _is_file_too_large(_object_size(S3_BUCKET, f'{bag_location}/data/{image_path}'),  max_size=LAMBDA_MAX_MEMORY_FOR_DERIV):
+    source_key = f'{bag_location}/data/{image_path}'
+    # the first ranged GET replaces a HEAD request for the size check and holds small sources entirely
+    response = _s3_get(S3_BUCKET, source_key, range_bytes=SOURCE_PREFETCH_BYTES)
+    source_size = _s3_total_size(response)
+    if _is_file_too_large(source_size, max_size=LAMBDA_MAX_MEMORY_FOR_DERIV):
         raise BadRequestError("The source image is too large")
+    with SpooledTemporaryFile(max_size=_spool_size(source_size)) as source_stream:
+        copyfileobj(response['Body'], source_stream, _1MB)
+        # the rest of a larger source continues from the prefetched bytes, pinned to the version already read
+        _s3_download(S3_BUCKET, source_key, source_stream, SOURCE_PREFETCH_BYTES, source_size, etag=response.get('ETag'))
+        source_stream.seek(0)
 
-    try:
-        source_image = Image.open(_s3_byte_stream(S3_BUCKET, f'{bag_location}/data/{image_path}'))
-    except Exception as e:
-        logger.error(f'Failed to open source image: {image_path}')
-        logger.error(traceback.format_exc())
-        return {'message': 'error opening source image'}
+        if USE_PYVIPS:
+            try:
+                image_data = _vips_resize(source_stream, float(scale))
+            except pyvips.Error:
+                logger.error(f'Failed to open source image: {image_path}')
+                logger.error(traceback.format_exc())
+                return {'message': 'error opening source image'}
+        else:
+            try:
+                source_image = Image.open(source_stream)
+            except Exception as e:
+                logger.error(f'Failed to open source image: {image_path}')
+                logger.error(traceback.format_exc())
+                return {'message': 'error opening source image'}
 
-    size = (x * float(scale) for x in source_image.size)
-    source_image.thumbnail(size, Image.Resampling.LANCZOS)  # Resize and apply antialiasing
+            size = tuple(x * float(scale) for x in source_image.size)
+            source_image.thumbnail(size, Image.Resampling.LANCZOS)  # Resize and apply antialiasing
 
-    image_file = io.BytesIO()
-    source_image.save(image_file, format='JPEG')
-    image_file.flush()
-    image_file.seek(0)
+            image_data = _encode_jpeg(source_image)
 
     try:
-        s3_client.put_object(Bucket=S3_BUCKET, Key=destination, Body=image_file)
-        logger.info(f'Created S3 object: {destination}')
+        s3_client.put_object(Bucket=S3_BUCKET, Key=destination, Body=image_data)
+        _s3_exists_cache[(S3_BUCKET, destination)] = True
+        logger.info('Created S3 object: %s', destination)
     except Exception as e:
         logger.error(f'Failed to create S3 object: {destination}')
         logger.error(traceback.format_exc())
@@ -367,21 +667,20 @@ def resize_individual(bag: str, scale: float, image_path: str, location: str = "
 @app.route('/resize/{bag}/{scale}')
 def resize(bag: str, scale: float) -> dict:
     """ API endpoint to resize images for specified bag """
-    deriv_queue = get_deriv_queue()
-    logger.debug(f'Using queue: {deriv_queue}')
-    logger.info(f'Processing {bag}')
+    deriv_queue_url = get_deriv_queue_url(_deriv_shard(bag))
+    logger.debug('Using queue: %s', deriv_queue_url)
+    logger.info('Processing %s', bag)
     location = _find_source_bag(bag)['location']
-    logger.info(f'Using location {location}')
+    logger.info('Using location %s', location)
+    message_bodies = []
     for image_details in images_source(bag, location):
         size = image_details.get('size')
         image_filename = image_details.get("file").split('/')[-1]
         if _is_file_too_large(size):
             logger.error(f"{image_filename} from {bag} is too large to process!")
         else:
-            resp = deriv_queue.send_message(
-                MessageBody=dumps((bag, scale, image_filename, location))
-            )
-            logger.debug(resp)
+            message_bodies.append(dumps((bag, scale, image_filename, location)))
+    _send_message_batches(deriv_queue_url, message_bodies)
     return {'message': 'submitted for processing'}
 
 
@@ -1,9 +1,53 @@
 import os
 import pytest
 import boto3
+from io import BytesIO
+from functools import cache
+from concurrent.futures import ThreadPoolExecutor
+from chalice.test import Client
 from moto import mock_aws
+from moto.core import DEFAULT_ACCOUNT_ID
+from moto.s3.models import s3_backends
+from moto.sqs.models import sqs_backends
+from PIL import Image, ImageColor
 
-@pytest.fixture
+from app import app, _s3_exists_cache, _find_source_location
+
+SESSION_KEYS = set()  # (bucket, key) pairs seeded by session fixtures - kept when a test's objects are dropped
+
+
+@cache
+def solid_image(mode, size, color_hex="#841617"):
+    """ solid color image shared between tests - callers only read or save it, never modify it """
+    return Image.new(mode=mode, size=size, color=ImageColor.getcolor(color_hex, mode))
+
+
+@cache
+def expected_images(prefix, ext, count, size):
+    """ the listing _images should yield for count sequentially numbered images - callers must not modify it """
+    return tuple({"file": f"{prefix}/data/image{index:03}.{ext}", "size": size} for index in range(count))
+
+
+def put_many(client, bucket, items, max_workers=16):
+    """ put (key, body) pairs concurrently - each put is a round trip through moto """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda item: client.put_object(Bucket=bucket, Key=item[0], Body=item[1]), items))
+
+
+def direct_put(bucket, key, body):
+    """ store an object straight into moto's S3 backend - skips request signing and the HTTP round trip """
+    s3_backends[DEFAULT_ACCOUNT_ID]["global"].put_object(bucket, key, body)
+
+
+@pytest.fixture(autouse=True)
+def clear_s3_caches():
+    """ reset TTL cached S3 lookups so results do not leak between tests """
+    yield
+    _find_source_location.cache_clear()
+    _s3_exists_cache.clear()
+
+
+@pytest.fixture(scope="session")
 def aws_credentials():
     """ assert mock environment set from pytest.ini """
     assert os.environ["AWS_ACCESS_KEY_ID"] == "TESTING"
@@ -13,40 +57,78 @@ def aws_credentials():
     assert os.environ["AWS_DEFAULT_REGION"] == "us-east-1"
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
+def aws_mock(aws_credentials):
+    """ one moto mock for the whole session - backends are reset between tests instead of re-created """
+    with mock_aws() as mock:
+        yield mock
+
+
+@pytest.fixture(scope="session", autouse=True)
+def cache_boto3_clients(aws_mock):
+    """ reuse boto3 clients and resources built with the same arguments - building them is slow """
+    with pytest.MonkeyPatch.context() as patcher:
+        patcher.setattr(boto3.Session, "client", cache(boto3.Session.client))
+        patcher.setattr(boto3.Session, "resource", cache(boto3.Session.resource))
+        yield
+
+
+@pytest.fixture(autouse=True)
+def reset_aws(aws_mock):
+    """ drop the objects and queues a test created - the session bucket itself is kept """
+    yield
+    s3_backend = s3_backends[DEFAULT_ACCOUNT_ID]["global"]
+    for bucket in s3_backend.buckets.values():
+        for key in list(bucket.keys):
+            if (bucket.name, key) not in SESSION_KEYS:
+                s3_backend.delete_object(bucket.name, key)
+    for regional_backends in sqs_backends.values():  # BackendDict.reset() would reset every service
+        for sqs_backend in regional_backends.values():
+            sqs_backend.reset()
+
+
+@pytest.fixture(scope="session")
 def default_env():
     assert os.environ["SQS_QUEUE_DERIV"] == "TEST-DERIV-QUEUE"
     assert os.environ["SQS_QUEUE_PDF"] == "TEST-PDF-QUEUE"
     assert os.environ["S3_BUCKET"] == "TEST-BUCKET"
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def bucket_name(default_env):
     return os.environ["S3_BUCKET"]
 
 
-@pytest.fixture
-def s3_client(aws_credentials):
-    with mock_aws():
-        yield boto3.client("s3", region_name="us-east-1")
+@pytest.fixture(scope="session")
+def s3_client(aws_mock):
+    return boto3.client("s3", region_name="us-east-1")
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def s3_test(s3_client, bucket_name):
+    """ create the bucket once - reset_aws empties it between tests """
     s3_client.create_bucket(Bucket=bucket_name)
     yield
 
 
-@pytest.fixture
-def sqs_resource(aws_credentials):
-    with mock_aws():
-        yield boto3.resource("sqs", region_name="us-east-1")
+@pytest.fixture(scope="session")
+def seeded_bag(s3_test, bucket_name):
+    """ source bag with only a bagit.txt (body b"test"), stored once for the session and read by many tests """
+    bag = "seeded_bag_2022"
+    key = f"source/{bag}/bagit.txt"
+    direct_put(bucket_name, key, b"test")
+    SESSION_KEYS.add((bucket_name, key))
+    return bag
 
 
-@pytest.fixture
-def sqs_client(aws_credentials):
-    with mock_aws():
-        yield boto3.client("sqs", region_name="us-east-1")
+@pytest.fixture(scope="session")
+def sqs_resource(aws_mock):
+    return boto3.resource("sqs", region_name="us-east-1")
+
+
+@pytest.fixture(scope="session")
+def sqs_client(aws_mock):
+    return boto3.client("sqs", region_name="us-east-1")
 
 
 @pytest.fixture
@@ -77,3 +159,26 @@ def sqs_test_pdf(sqs_resource, pdf_queue):
             "VisibilityTimeout": "60"
         }
     )
+
+
+@pytest.fixture(scope="session")
+def solid_jpeg_bytes():
+    """ 300x400 solid color JPEG, encoded once for the session """
+    with BytesIO() as output:
+        solid_image("RGB", (300, 400)).save(output, format="JPEG")
+        return output.getvalue()
+
+
+@pytest.fixture(scope="session")
+def solid_tiff_bytes():
+    """ 300x400 solid color TIFF, encoded once for the session """
+    with BytesIO() as output:
+        solid_image("RGB", (300, 400)).save(output, format="TIFF")
+        return output.getvalue()
+
+
+@pytest.fixture(scope="session")
+def chalice_client():
+    """ one chalice test client for the session - it loads the chalice config once and keeps it """
+    with Client(app) as client:
+        yield client
@@ -2,18 +2,22 @@ import os
 import boto3
 import pytest
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 from functools import cache
 from json import loads
 from unittest.mock import patch
-from chalice.app import NotFoundError, BadRequestError
-from chalice.test import Client
-from PIL import Image, ImageColor
-
-from app import app, get_s3_client, get_s3_paginator, get_sqs, get_deriv_queue, get_pdf_queue, \
-    _is_file_too_large, _filter_keep, _images, _find_source_bag, _s3_byte_stream, _object_size, \
-    _generate_pdf, resize_individual, images_source, images_derivative, available_derivatives, \
+from botocore.exceptions import ClientError
+from chalice.app import NotFoundError, BadRequestError, ChaliceViewError
+from PIL import Image, UnidentifiedImageError
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import IndirectObject
+
+from app import get_s3_client, get_s3_paginator, get_sqs, get_deriv_queue_url, get_pdf_queue_url, \
+    _deriv_queue_name, _deriv_shard, _is_file_too_large, _filter_keep, _encode_jpeg, _vips_resize, _images, _find_source_bag, _s3_object_exists, _s3_copy, _spool_size, _s3_download, _s3_byte_stream, \
+    _send_message_batches, _prefetch_images, _add_pdf_page, _generate_pdf, resize_individual, images_source, images_derivative, available_derivatives, \
     resize
-from app import DEFAULT_IMAGE_EXTENSIONS, DEFAULT_IMAGE_SCALE
+from app import DEFAULT_IMAGE_EXTENSIONS, DEFAULT_IMAGE_SCALE, S3_STREAM_SPOOL_SIZE, _s3_exists_cache
+from tests.conftest import put_many, solid_image, expected_images
 
 
 def test_default_regions(aws_credentials, s3_client):
@@ -44,139 +48,337 @@ def test_caching():
     n1 = noncached_result()
     n2 = noncached_result()
 
-    assert id(c1) == id(c2)  # these are the same object instance
-    assert id(n1) != id(n2)  # these point to different instances
+    assert c1 is c2  # these are the same object instance
+    assert n1 is not n2  # these point to different instances
 
 
 def test_get_s3_client_reuses_object_instance(s3_client):
     s3_1 = get_s3_client()
     s3_2 = get_s3_client()
-    assert id(s3_1) == id(s3_2)  # these are the same object instance
-    assert id(s3_1) != id(s3_client)  # these point to different instances
+    assert s3_1 is s3_2  # these are the same object instance
+    assert s3_1 is not s3_client  # these point to different instances
 
 
 def test_get_s3_paginator_reuses_object_instance():
     paginator_1 = get_s3_paginator()
     paginator_2 = get_s3_paginator()
-    assert id(paginator_1) == id(paginator_2)  # these are the same object instance
+    assert paginator_1 is paginator_2  # these are the same object instance
 
 
 def test_get_sqs_reuses_object_instance():
     sqs_1 = get_sqs()
     sqs_2 = get_sqs()
-    assert id(sqs_1) == id(sqs_2)  # these are the same object instance
+    assert sqs_1 is sqs_2  # these are the same object instance
+
+
+def test_get_deriv_queue_url_reuses_object_instance(sqs_test_deriv):
+    deriv_queue_1 = get_deriv_queue_url()
+    deriv_queue_2 = get_deriv_queue_url()
+    assert deriv_queue_1 is deriv_queue_2  # these are the same object instance
+    assert deriv_queue_1 == sqs_test_deriv.url
+
+
+def test_get_pdf_queue_url_reuses_object_instance(sqs_test_pdf):
+    pdf_queue_1 = get_pdf_queue_url()
+    pdf_queue_2 = get_pdf_queue_url()
+    assert pdf_queue_1 is pdf_queue_2  # these are the same object instance
+    assert pdf_queue_1 == sqs_test_pdf.url
 
 
-def test_get_deriv_queue_reuses_object_instance(sqs_test_deriv):
-    deriv_queue_1 = get_deriv_queue()
-    deriv_queue_2 = get_deriv_queue()
-    assert id(deriv_queue_1) == id(deriv_queue_2)  # these are the same object instance
+def test_get_pdf_queue_url_from_environment(monkeypatch):
+    monkeypatch.setattr("app.SQS_QUEUE_PDF_URL", "https://sqs.us-east-1.amazonaws.com/123456789012/TEST-PDF-QUEUE")
+    get_pdf_queue_url.cache_clear()
+    assert get_pdf_queue_url() == "https://sqs.us-east-1.amazonaws.com/123456789012/TEST-PDF-QUEUE"  # no lookup needed
+    get_pdf_queue_url.cache_clear()
 
 
-def test_get_pdf_queue_reuses_object_instance(sqs_test_pdf):
-    pdf_queue_1 = get_pdf_queue()
-    pdf_queue_2 = get_pdf_queue()
-    assert id(pdf_queue_1) == id(pdf_queue_2)  # these are the same object instance
+def test__deriv_queue_name():
+    assert _deriv_queue_name(0) == "TEST-DERIV-QUEUE"
+    assert _deriv_queue_name(3) == "TEST-DERIV-QUEUE-3"
 
 
-def test__is_file_too_large():
-    assert _is_file_too_large(file_sizes=1024, max_size=1024, buffer_ratio=0.3) == True
-    assert _is_file_too_large(file_sizes=(1024), max_size=1024, buffer_ratio=0.3) == True
-    assert _is_file_too_large(file_sizes=716, max_size=1024, buffer_ratio=0.3) == False
-    assert _is_file_too_large(file_sizes=717, max_size=1024, buffer_ratio=0.3) == True
-    assert _is_file_too_large(file_sizes=716.8, max_size=1024, buffer_ratio=0.3) == False
-    assert _is_file_too_large(file_sizes=716.9, max_size=1024, buffer_ratio=0.3) == True
+def test__deriv_shard():
+    assert _deriv_shard("test_bag_2022", shards=1) == 0
+    assert {_deriv_shard(f"bag_{index}", shards=8) for index in range(100)} == set(range(8))
+    assert _deriv_shard("test_bag_2022", shards=8) == _deriv_shard("test_bag_2022", shards=8)
 
 
-def test__filter_keep():
-    for ext in DEFAULT_IMAGE_EXTENSIONS:
-        assert _filter_keep(f"data/test.{ext}") == True
-        assert _filter_keep(f"data/test_orig.{ext}") == False
-        assert _filter_keep(f"data/.test.{ext}") == False
-        assert _filter_keep(f"data/.test.{ext}.bak") == False
+@pytest.mark.parametrize("size,expected", [(1024, True), (716, False), (717, True), (716.8, False), (716.9, True)])
+def test__is_file_too_large(size, expected):
+    assert _is_file_too_large(file_sizes=size, max_size=1024, buffer_ratio=0.3) == expected
 
+
+@pytest.mark.parametrize("ext", DEFAULT_IMAGE_EXTENSIONS)
+def test__filter_keep(ext):
+    assert _filter_keep(f"data/test.{ext}") == True
+    assert _filter_keep(f"data/test_orig.{ext}") == False
+    assert _filter_keep(f"data/.test.{ext}") == False
+    assert _filter_keep(f"data/.test.{ext}.bak") == False
+
+
+def test__filter_keep_unlisted_extension():
     assert "gif" not in DEFAULT_IMAGE_EXTENSIONS
     assert _filter_keep("data/test.gif") == False
 
 
 def test__images(s3_client, s3_test, bucket_name):
     prefix = "source/test_bag_2022"
-    body = "test"
+    body = b"test"
     count = 10
-    for index in range(count):
-        s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image{index:03}.tif", Body=body)
-        s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image{index:03}_orig.tif", Body=body)
-        s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image{index:03}.CR2", Body=body)
-    
-    assert list(_images(prefix=prefix)) == [{"file": f"{prefix}/data/image{index:03}.tif", "size": len(body)} for index in range(count)]
-    assert list(_images(prefix=prefix, extensions=("does_not_exist_in_list"))) == []
+    put_many(s3_client, bucket_name, [
+        (f"{prefix}/data/image{index:03}{suffix}", body)
+        for index in range(count)
+        for suffix in (".tif", "_orig.tif", ".CR2")
+    ])
 
+    assert tuple(_images(prefix=prefix)) == expected_images(prefix, "tif", count, len(body))
+    assert tuple(_images(prefix=prefix, extensions=("does_not_exist_in_list"))) == ()
 
-def test__find_source_bag(s3_client, s3_test, bucket_name):
-    prefix = "source/test_bag_2022"
-    s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/bagit.txt", Body="test")
-    assert _find_source_bag("test_bag_2022") == {"location": prefix}
+
+def test__find_source_bag(seeded_bag):
+    assert _find_source_bag(seeded_bag) == {"location": f"source/{seeded_bag}"}
 
     with pytest.raises(NotFoundError):
         _find_source_bag("does_not_exist")
     
 
-def test__s3_byte_stream(s3_client, s3_test, bucket_name):
-    prefix = "source/test_bag_2022"
-    body = b"test"
-    s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/bagit.txt", Body=body)
-    assert _s3_byte_stream(bucket=bucket_name, key=f"{prefix}/bagit.txt").read() == body
+def test__s3_object_exists(s3_client, s3_test, bucket_name):
+    key = "derivative/test_bag_2022/pdf/test_bag_2022.pdf"
+    assert _s3_object_exists(bucket_name, key) == False
+    s3_client.put_object(Bucket=bucket_name, Key=key, Body=b"test")
+    assert _s3_object_exists(bucket_name, key) == False  # recent answer is reused
+    _s3_exists_cache.clear()
+    assert _s3_object_exists(bucket_name, key) == True
+
+
+def test__s3_object_exists_transient_error(s3_client, s3_test, bucket_name, monkeypatch):
+    key = "derivative/test_bag_2022/pdf/test_bag_2022.pdf"
+    s3_client.put_object(Bucket=bucket_name, Key=key, Body=b"test")
+
+    def head_object(**kwargs):
+        raise ClientError({"Error": {"Code": "503", "Message": "Slow Down"}}, "HeadObject")
+
+    monkeypatch.setattr(get_s3_client(), "head_object", head_object)
+    assert _s3_object_exists(bucket_name, key) == False
+    monkeypatch.undo()
+    assert _s3_object_exists(bucket_name, key) == True  # the error was not remembered
+
+
+def test__s3_copy(s3_client, s3_test, bucket_name):
+    key = "source/test_bag_2022/bagit.txt"
+    body = b"test data"
+    s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+    with BytesIO() as output:
+        assert _s3_copy(bucket=bucket_name, key=key, stream=output, range_bytes=4) == len(body)
+        assert output.getvalue() == body[:4]
+        assert _s3_copy(bucket=bucket_name, key=key, stream=output, first_byte=4) == len(body)
+        assert output.getvalue() == body
+
+    s3_client.put_object(Bucket=bucket_name, Key="source/test_bag_2022/empty.txt", Body=b"")
+    assert _s3_copy(bucket=bucket_name, key="source/test_bag_2022/empty.txt", stream=BytesIO(), range_bytes=4) == 0
 
     with pytest.raises(NotFoundError):
-        _s3_byte_stream(bucket=bucket_name, key="does_not_exist").read()
+        _s3_copy(bucket=bucket_name, key="does_not_exist", stream=BytesIO())
 
 
-def test__object_size(s3_client, s3_test, bucket_name):
-    prefix = "source/test_bag_2022"
-    body = b"test"
-    s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/bagit.txt", Body=body)
-    assert _object_size(bucket=bucket_name, key=f"{prefix}/bagit.txt") == len(body)
+def test__spool_size(monkeypatch):
+    monkeypatch.setattr("app.LAMBDA_EPHEMERAL_STORAGE", 1024)
+    assert _spool_size(700) == S3_STREAM_SPOOL_SIZE
+    assert _spool_size(700, spool_size=64) == 64
+    assert _spool_size(800) == 0  # may not fit in /tmp - kept in memory
+
+
+def test__s3_download(s3_client, s3_test, bucket_name):
+    key = "source/test_bag_2022/data/image001.tif"
+    body = bytes(range(256)) * 8
+    etag = s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)["ETag"]
+    with BytesIO() as output:
+        output.write(body[:100])
+        _s3_download(bucket=bucket_name, key=key, stream=output, first_byte=100, size=len(body), etag=etag, chunk_size=256, max_workers=4)
+        assert output.getvalue() == body
+
+    s3_client.put_object(Bucket=bucket_name, Key=key, Body=body[::-1])  # changed since the first GET
+    with pytest.raises(BadRequestError):
+        _s3_download(bucket=bucket_name, key=key, stream=BytesIO(), first_byte=100, size=len(body), etag=etag)
 
     with pytest.raises(NotFoundError):
-        _object_size(bucket=bucket_name, key="does_not_exist")
+        _s3_download(bucket=bucket_name, key="does_not_exist", stream=BytesIO(), first_byte=0, size=len(body))
 
 
-def test__generate_pdf(s3_client, s3_test, bucket_name):
-    prefix = f"derivative/test_bag_2022/{DEFAULT_IMAGE_SCALE}"
-    count = 10
+def test__s3_byte_stream(seeded_bag, bucket_name):
+    assert _s3_byte_stream(bucket=bucket_name, key=f"source/{seeded_bag}/bagit.txt").read() == b"test"
+
+    with pytest.raises(NotFoundError):
+        _s3_byte_stream(bucket=bucket_name, key="does_not_exist").read()
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L", "RGBA", "1", "I;16"])
+def test__encode_jpeg(mode):
+    image = solid_image(mode, (300, 400))
+    encoded = Image.open(BytesIO(_encode_jpeg(image)))
+    assert encoded.format == "JPEG"
+    assert encoded.size == (300, 400)
+    assert encoded.mode == ("RGB" if mode in ("RGB", "RGBA") else "L")
+
+
+def test__encode_jpeg_16_bit():
+    encoded = Image.open(BytesIO(_encode_jpeg(Image.new("I;16", (16, 16), 0x8000))))
+    assert abs(encoded.getpixel((8, 8)) - 0x80) <= 1  # scaled to 8 bits, not clipped to white
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L", "RGBA"])
+def test__vips_resize(mode):
+    pytest.importorskip("pyvips")
     with BytesIO() as output:
-        Image.new( mode = "RGB", size = (300, 400), color = ImageColor.getrgb("#841617") ).save(output, format="JPEG")
-        for index in range(count):
+        solid_image(mode, (300, 400)).save(output, format="TIFF")
+        output.seek(0)
+        resized = Image.open(BytesIO(_vips_resize(output, 0.4)))
+    assert resized.format == "JPEG"
+    assert resized.size == (120, 160)
+
+
+def test__vips_resize_never_enlarges():
+    pytest.importorskip("pyvips")
+    with BytesIO() as output:
+        solid_image("RGB", (300, 400)).save(output, format="TIFF")
+        output.seek(0)
+        resized = Image.open(BytesIO(_vips_resize(output, 2.0)))
+    assert resized.size == (300, 400)  # matches Pillow's thumbnail
+
+
+def test__prefetch_images(s3_client, s3_test, bucket_name):
+    prefix = f"derivative/test_bag_2022/{DEFAULT_IMAGE_SCALE}"
+    count = 5
+    for index in range(count):
+        with BytesIO() as output:
+            solid_image("RGB", (100 + index, 100)).save(output, format="JPEG")
             output.seek(0)
             s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image{index:03}.jpg", Body=output)
+    image_paths = tuple(f"{prefix}/data/image{index:03}.jpg" for index in range(count))
+    assert [image.size for image in _prefetch_images(image_paths, max_workers=2)] == [(100 + index, 100) for index in range(count)]
+
+    pages = _prefetch_images(image_paths + ("does_not_exist",) * 10, max_workers=2)
+    assert next(pages).size == (100, 100)
+    pages.close()  # remaining downloads are abandoned without raising
+
+
+def test__add_pdf_page():
+    pdf = PdfWriter()
+    with BytesIO() as jpeg, BytesIO() as png:
+        solid_image("RGB", (300, 400)).save(jpeg, format="JPEG")
+        solid_image("L", (200, 100), "#808080").save(png, format="PNG")
+        _add_pdf_page(pdf, Image.open(jpeg))
+        _add_pdf_page(pdf, Image.open(png))
+        _add_pdf_page(pdf, solid_image("1", (50, 60), "#ffffff"))
+        jpeg_data = jpeg.getvalue()
+    with BytesIO() as output:
+        pdf.write(output)
+        reader = PdfReader(output)
+        assert [(page.mediabox.width, page.mediabox.height) for page in reader.pages] == [(300, 400), (200, 100), (50, 60)]
+        assert reader.pages[0].images[0].data == jpeg_data  # embedded without re-encoding
+        assert reader.pages[1].images[0].image.mode == "L"
+        assert reader.pages[2].images[0].image.mode == "L"  # bilevel pages are grayscale
+        for page in reader.pages:  # image streams must be written as indirect objects, not inline in the page
+            assert isinstance(page["/Resources"]["/XObject"].raw_get("/Im0"), IndirectObject)
+
+
+def test__generate_pdf(s3_client, s3_test, bucket_name, solid_jpeg_bytes):
+    prefix = f"derivative/test_bag_2022/{DEFAULT_IMAGE_SCALE}"
+    count = 10
+    put_many(s3_client, bucket_name, [(f"{prefix}/data/image{index:03}.jpg", solid_jpeg_bytes) for index in range(count)])
     assert _generate_pdf("test_bag_2022") == {"message": "success"}
     assert _generate_pdf("test_bag_2022") == {"message": "PDF already exists"}
     assert _generate_pdf("does_not_exist") == {"message": "missing derivative to generate PDF"}
 
+    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/raw_only_bag/{DEFAULT_IMAGE_SCALE}/image001.CR2", Body=b"test data")
+    assert _generate_pdf("raw_only_bag") == {"message": "missing derivative to generate PDF"}
+
+
+def test__generate_pdf_stubbed(s3_test, bucket_name, solid_jpeg_bytes, monkeypatch):
+    prefix = f"derivative/test_bag_2022/{DEFAULT_IMAGE_SCALE}"
+    count = 10
+
+    def byte_stream(bucket, key):
+        if key.endswith("manifest.json"):
+            raise NotFoundError(key)
+        return BytesIO(solid_jpeg_bytes)
+
+    monkeypatch.setattr("app._images", lambda *args, **kwargs: [{"file": f"{prefix}/data/image{index:03}.jpg", "size": len(solid_jpeg_bytes)} for index in range(count)])
+    monkeypatch.setattr("app._s3_byte_stream", byte_stream)
+    assert _generate_pdf("test_bag_2022") == {"message": "success"}
+
+    monkeypatch.setattr("app._images", lambda *args, **kwargs: [])
+    assert _generate_pdf("does_not_exist") == {"message": "missing derivative to generate PDF"}
+
+
+def test__generate_pdf_exceeds_tmp(s3_client, s3_test, bucket_name, solid_jpeg_bytes, monkeypatch):
+    prefix = f"derivative/test_bag_2022/{DEFAULT_IMAGE_SCALE}"
+    spool_sizes = []
+
+    def spooled_file(max_size):
+        spool_sizes.append(max_size)
+        return SpooledTemporaryFile(max_size=max_size)
+
+    monkeypatch.setattr("app.SpooledTemporaryFile", spooled_file)
+    monkeypatch.setattr("app.LAMBDA_EPHEMERAL_STORAGE", len(solid_jpeg_bytes))
+    s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image001.jpg", Body=solid_jpeg_bytes)
+    assert _generate_pdf("test_bag_2022") == {"message": "success"}
+    assert spool_sizes[-1] == 0  # the PDF stays in memory
+
 
 def test__generate_pdf_invalid_image(s3_client, s3_test, bucket_name):
     prefix = f"derivative/test_bag_2022/{DEFAULT_IMAGE_SCALE}"
     s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image001.jpg", Body=b"invalid image data")
-    with pytest.raises(BadRequestError):
-        _generate_pdf("test_bag_2022") == {"message": "success"}
+    with patch("app.Image.open", side_effect=UnidentifiedImageError()) as mock_open, pytest.raises(BadRequestError):
+        _generate_pdf("test_bag_2022")
+    mock_open.assert_called_once()
 
 
-def test__generate_pdf_exceeds_buffer(s3_client, s3_test, bucket_name):
+def test__generate_pdf_exceeds_buffer(s3_client, s3_test, bucket_name, solid_jpeg_bytes, monkeypatch):
     prefix = f"derivative/test_bag_2022/{DEFAULT_IMAGE_SCALE}"
-    mock_max_memory = patch("app.LAMBDA_MAX_MEMORY_FOR_PDF", 0)
-    mock_max_memory.start()
-    with BytesIO() as output:
-        Image.new( mode = "RGB", size = (300, 400), color = ImageColor.getrgb("#841617") ).save(output, format="JPEG")
-        output.seek(0)
-        s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image001.jpg", Body=output)
+    monkeypatch.setattr("app.LAMBDA_MAX_MEMORY_FOR_PDF", 0)
+    s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image001.jpg", Body=solid_jpeg_bytes)
     assert _generate_pdf("test_bag_2022") == {"message": "Memory limit exceeded!"}
-    mock_max_memory.stop()
+
+
+def test__generate_pdf_manifest(s3_client, s3_test, bucket_name, solid_jpeg_bytes, monkeypatch):
+    bag = "test_bag_2022"
+    prefix = f"derivative/{bag}/{DEFAULT_IMAGE_SCALE}"
+    manifest_key = f"manifest/pdf/{bag}.json"
+    monkeypatch.setattr("app.LAMBDA_MAX_MEMORY_FOR_PDF", int(len(solid_jpeg_bytes) * 1.5 / 0.7))  # room for one page, not two
+    put_many(s3_client, bucket_name, [(f"{prefix}/data/image{index:03}.jpg", solid_jpeg_bytes) for index in range(2)])
+    assert _generate_pdf(bag) == {"message": "Memory limit exceeded!"}
+
+    manifest = loads(s3_client.get_object(Bucket=bucket_name, Key=manifest_key)["Body"].read())
+    assert manifest == {"total_size": 2 * len(solid_jpeg_bytes), "page_count": 2, "paths": [f"{prefix}/data/image{index:03}.jpg" for index in range(2)]}
+    assert available_derivatives(bag) == [str(DEFAULT_IMAGE_SCALE)]  # the manifest is not listed as a derivative
+
+    s3_client.delete_object(Bucket=bucket_name, Key=f"{prefix}/data/image001.jpg")
+    assert _generate_pdf(bag) == {"message": "Memory limit exceeded!"}  # recent refusal, refused without listing
+
+    monkeypatch.setattr("app.PDF_MANIFEST_TTL", 0)  # the refusal has expired
+    assert _generate_pdf(bag) == {"message": "success"}  # listed again and the remaining page fits
+    assert s3_client.list_objects_v2(Bucket=bucket_name, Prefix=manifest_key)["KeyCount"] == 0
+
+
+def test__generate_pdf_manifest_unreadable(s3_client, s3_test, bucket_name, solid_jpeg_bytes):
+    prefix = f"derivative/test_bag_2022/{DEFAULT_IMAGE_SCALE}"
+    s3_client.put_object(Bucket=bucket_name, Key="manifest/pdf/test_bag_2022.json", Body=b"not json")
+    s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image001.jpg", Body=solid_jpeg_bytes)
+    assert _generate_pdf("test_bag_2022") == {"message": "success"}  # falls back to listing
+
+
+def test__generate_pdf_manifest_only_on_refusal(s3_client, s3_test, bucket_name, solid_jpeg_bytes):
+    prefix = f"derivative/test_bag_2022/{DEFAULT_IMAGE_SCALE}"
+    s3_client.put_object(Bucket=bucket_name, Key=f"{prefix}/data/image001.jpg", Body=solid_jpeg_bytes)
+    assert _generate_pdf("test_bag_2022") == {"message": "success"}
+    assert s3_client.list_objects_v2(Bucket=bucket_name, Prefix="manifest/pdf/")["KeyCount"] == 0
 
 
 def test_available_derivatives(s3_client, s3_test, bucket_name):
     bag = "test_bag_2022"
-    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.4/image001.jpg", Body="test data")
-    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.6/image001.jpg", Body="test data")
+    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.4/image001.jpg", Body=b"test data")
+    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.6/image001.jpg", Body=b"test data")
 
     assert sorted(available_derivatives(bag)) == ["0.4", "0.6"]
 
@@ -186,8 +388,8 @@ def test_available_derivatives(s3_client, s3_test, bucket_name):
 
 def test_images_derivatives(s3_client, s3_test, bucket_name):
     bag = "test_bag_2022"
-    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.4/image001.jpg", Body="test data")
-    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.4/image002.jpg", Body="test data")
+    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.4/image001.jpg", Body=b"test data")
+    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.4/image002.jpg", Body=b"test data")
 
     assert sorted(record["file"] for record in images_derivative(bag)) == [
         'derivative/test_bag_2022/0.4/image001.jpg',
@@ -198,91 +400,172 @@ def test_images_derivatives(s3_client, s3_test, bucket_name):
         images_derivative("does_not_exist")
 
 
-def test_resize_individual(s3_client, s3_test, bucket_name):
+def test_images_source_not_cached(s3_client, s3_test, bucket_name):
+    bag = "test_bag_2022"
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=b"test data")
+    assert len(images_source(bag, f"source/{bag}")) == 1
+
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image002.tif", Body=b"test data")
+    assert len(images_source(bag, f"source/{bag}")) == 2  # new uploads are listed right away, e.g. by resize
+
+
+def test_resize_individual(s3_client, s3_test, bucket_name, solid_tiff_bytes, monkeypatch):
     bag = "test_bag_2022"
     size = (300, 400)
-    with BytesIO() as output:
-        Image.new(mode="RGB", size=size, color=ImageColor.getrgb("#841617")).save(output, format="TIFF")
-        output.seek(0)
-        s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=output)
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/bagit.txt", Body=b"test")
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=solid_tiff_bytes)
 
     assert images_source(bag=bag)[0]["file"] == f"source/{bag}/data/image001.tif"
 
+    uploads = {}
+    put_object = get_s3_client().put_object
+
+    def capture_put_object(**kwargs):
+        uploads[kwargs["Key"]] = kwargs["Body"]
+        return put_object(**kwargs)
+
+    monkeypatch.setattr(get_s3_client(), "put_object", capture_put_object)
     assert resize_individual(bag=bag, scale=0.4, image_path="image001.tif", location=f"source/{bag}") == {'message': 'created resized image'}
     assert available_derivatives(bag) == ["0.4"]
 
     assert images_derivative(bag=bag, scale=0.4)[0]["file"] == f"derivative/{bag}/0.4/image001.jpg"
 
-    img = Image.open(_s3_byte_stream(bucket=bucket_name, key=f"derivative/{bag}/0.4/image001.jpg"))
+    img = Image.open(BytesIO(uploads[f"derivative/{bag}/0.4/image001.jpg"]))  # the uploaded body - no download needed
     assert img.size == tuple(map(lambda x: x * 0.4, size))
 
 
+def test_resize_individual_jpeg(s3_client, s3_test, bucket_name, monkeypatch):
+    monkeypatch.setattr("app.SOURCE_PREFETCH_BYTES", 1024)  # the rest of the source comes from ranged GETs
+    bag = "test_bag_2022"
+    size = (3000, 4000)
+    with BytesIO() as output:
+        solid_image("RGB", size).save(output, format="JPEG")
+        output.seek(0)
+        s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.jpg", Body=output)
+
+    assert resize_individual(bag=bag, scale=0.1, image_path="image001.jpg", location=f"source/{bag}") == {'message': 'created resized image'}
+
+    img = Image.open(_s3_byte_stream(bucket=bucket_name, key=f"derivative/{bag}/0.1/image001.jpg"))
+    assert img.size == (300, 400)
+
+
+def test__resize_individual_empty_image(s3_client, s3_test, bucket_name):
+    bag = "test_bag_2022"
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=b"")
+    assert resize_individual(bag=bag, scale=0.4, image_path="image001.tif", location=f"source/{bag}") == {'message': 'error opening source image'}
+
+
 def test__resize_individual_invalid_image(s3_client, s3_test, bucket_name):
     bag = "test_bag_2022"
     s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=b"invalid image data")
-    assert resize_individual(bag=bag, scale=0.4, image_path="image001.tif", location=f"source/{bag}") == {'message': 'error opening source image'}
+    with patch("app.Image.open", side_effect=UnidentifiedImageError()) as mock_open:
+        assert resize_individual(bag=bag, scale=0.4, image_path="image001.tif", location=f"source/{bag}") == {'message': 'error opening source image'}
+    mock_open.assert_called_once()
 
 
-def test_resize_individual_exceeds_buffer(s3_client, s3_test, bucket_name):
+def test_resize_individual_vips(s3_client, s3_test, bucket_name, solid_tiff_bytes, monkeypatch):
+    pytest.importorskip("pyvips")
+    monkeypatch.setattr("app.USE_PYVIPS", True)
     bag = "test_bag_2022"
-    size = (300, 400)
-    with BytesIO() as output:
-        Image.new(mode="RGB", size=size, color=ImageColor.getrgb("#841617")).save(output, format="TIFF")
-        output.seek(0)
-        s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=output)
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=solid_tiff_bytes)
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image002.tif", Body=b"invalid image data")
+
+    assert resize_individual(bag=bag, scale=0.4, image_path="image001.tif", location=f"source/{bag}") == {'message': 'created resized image'}
+    assert resize_individual(bag=bag, scale=0.4, image_path="image002.tif", location=f"source/{bag}") == {'message': 'error opening source image'}
+
+    img = Image.open(_s3_byte_stream(bucket=bucket_name, key=f"derivative/{bag}/0.4/image001.jpg"))
+    assert img.size == (120, 160)
+
+
+def test_resize_individual_exceeds_buffer(s3_client, s3_test, bucket_name, solid_tiff_bytes, monkeypatch):
+    bag = "test_bag_2022"
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=solid_tiff_bytes)
 
-    mock_max_memory = patch("app.LAMBDA_MAX_MEMORY_FOR_DERIV", 0)
-    mock_max_memory.start()
+    monkeypatch.setattr("app.LAMBDA_MAX_MEMORY_FOR_DERIV", 0)
     with pytest.raises(BadRequestError):
         resize_individual(bag=bag, scale=0.4, image_path="image001.tif", location=f"source/{bag}")
-    mock_max_memory.stop()
 
 
 def test_resize_individual_alread_exists(s3_client, s3_test, bucket_name):
     bag = "test_bag_2022"
-    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.4/image001.jpg", Body="test data")
+    s3_client.put_object(Bucket=bucket_name, Key=f"derivative/{bag}/0.4/image001.jpg", Body=b"test data")
     assert resize_individual(bag=bag, scale=0.4, image_path="image001.tif", location=f"source/{bag}") == {'message': 'image already exists'}
 
 
 def test_resize(sqs_client, sqs_test_deriv, s3_client, s3_test, bucket_name):
     bag = "test_bag_2022"
     scale = 0.4
-    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body="test data")
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/bagit.txt", Body=b"test")
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=b"test data")
     assert resize(bag=bag, scale=scale) == {'message': 'submitted for processing'}
     messages = sqs_client.receive_message(QueueUrl=sqs_test_deriv.url)["Messages"]
     assert loads(messages[0]["Body"]) == [bag, scale, "image001.tif", f"source/{bag}"]
 
 
+def test__send_message_batches(sqs_client, sqs_test_deriv):
+    bodies = [f"message{index:02}" for index in range(25)]
+    _send_message_batches(sqs_test_deriv.url, bodies)
+    received = []
+    while messages := sqs_client.receive_message(QueueUrl=sqs_test_deriv.url, MaxNumberOfMessages=10).get("Messages"):
+        received.extend(message["Body"] for message in messages)
+    assert sorted(received) == bodies
+
+
+def test__send_message_batches_failed(sqs_client, sqs_test_deriv, monkeypatch):
+    sqs = get_sqs()
+    send_message_batch = sqs.send_message_batch
+    calls = []
+
+    def failing_send_message_batch(QueueUrl, Entries):  # "message00" is never accepted
+        calls.append([entry["Id"] for entry in Entries])
+        failed = [entry for entry in Entries if entry["MessageBody"] == "message00"]
+        sent = [entry for entry in Entries if entry not in failed]
+        successful = send_message_batch(QueueUrl=QueueUrl, Entries=sent)["Successful"] if sent else []
+        return {"Successful": successful, "Failed": [{"Id": entry["Id"], "SenderFault": False, "Code": "InternalError"} for entry in failed]}
+
+    monkeypatch.setattr(sqs, "send_message_batch", failing_send_message_batch)
+    with pytest.raises(ChaliceViewError):
+        _send_message_batches(sqs_test_deriv.url, ["message00", "message01"])
+    assert calls == [["0", "1"], ["0"]]  # only the failed entry is retried, once
+    messages = sqs_client.receive_message(QueueUrl=sqs_test_deriv.url, MaxNumberOfMessages=10)["Messages"]
+    assert [message["Body"] for message in messages] == ["message01"]
+
+
+def test_resize_sharded(sqs_client, sqs_resource, s3_client, s3_test, bucket_name, monkeypatch):
+    bag = "test_bag_2022"
+    monkeypatch.setattr("app.SQS_QUEUE_DERIV_SHARDS", 4)
+    shard_queue = sqs_resource.create_queue(QueueName=_deriv_queue_name(_deriv_shard(bag)))
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/bagit.txt", Body=b"test")
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=b"test data")
+    assert resize(bag=bag, scale=0.4) == {'message': 'submitted for processing'}
+    messages = sqs_client.receive_message(QueueUrl=shard_queue.url)["Messages"]
+    assert loads(messages[0]["Body"]) == [bag, 0.4, "image001.tif", f"source/{bag}"]
+
+
 def test_resize_nonexisting_bag(s3_client, s3_test, bucket_name):
     with pytest.raises(NotFoundError):
         resize(bag="does_not_exist", scale=0.4)
 
 
-def test_deriv_generator(s3_client, s3_test, bucket_name):
+def test_deriv_generator(s3_client, s3_test, bucket_name, solid_tiff_bytes, chalice_client):
     bag = "test_bag_2022"
-    size = (300, 400)
     scale = 0.4
-    with BytesIO() as output:
-        Image.new(mode="RGB", size=size, color=ImageColor.getrgb("#841617")).save(output, format="TIFF")
-        output.seek(0)
-        s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=output)
+    s3_client.put_object(Bucket=bucket_name, Key=f"source/{bag}/data/image001.tif", Body=solid_tiff_bytes)
 
-    with Client(app) as client:
-        client.lambda_.invoke(
-            "deriv_generator",
-            client.events.generate_sqs_event(message_bodies=[f'["{bag}", {scale}, "image001.tif", "source/{bag}"]'])
-        )
+    chalice_client.lambda_.invoke(
+        "deriv_generator",
+        chalice_client.events.generate_sqs_event(message_bodies=[f'["{bag}", {scale}, "image001.tif", "source/{bag}"]'])
+    )
 
     assert list(_images(prefix=f"derivative/{bag}/{scale}"))[0]["file"] == f"derivative/{bag}/{scale}/image001.jpg"
 
 
 @pytest.mark.skip(reason="needs an assertion to test")
-def test_deriv_generator_nonexistant_image(s3_client, s3_test, bucket_name):
+def test_deriv_generator_nonexistant_image(s3_client, s3_test, bucket_name, chalice_client):
     bag = "does_not_exist"
     scale = 0.4
 
-    with Client(app) as client:
-        client.lambda_.invoke(
-            "deriv_generator",
-            client.events.generate_sqs_event(message_bodies=[f'["{bag}", {scale}, "image001.tif", "source/{bag}"]'])
-        )
+    chalice_client.lambda_.invoke(
+        "deriv_generator",
+        chalice_client.events.generate_sqs_event(message_bodies=[f'["{bag}", {scale}, "image001.tif", "source/{bag}"]'])
+    )